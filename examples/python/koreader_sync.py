@@ -20,21 +20,31 @@ import hashlib
 import json
 import os
 import time
-import uuid
 import pathlib
 import logging
+import sqlite3
 import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, asdict
-from typing import Optional, Dict, Any, Callable, List
+from typing import TYPE_CHECKING, Optional, Dict, Any, Callable, Iterable, List
 
-import requests
+if TYPE_CHECKING:
+    import requests
+
+try:  # optional: faster JSON encode/decode on the HTTP path
+    import orjson
+except ImportError:
+    orjson = None
 
 # ---------------- Configuration ---------------- #
 
 BASE_URL = "https://sync.koreader.rocks"
 ACCEPT_HEADER = "application/vnd.koreader.v1+json"
+JSON_HEADERS = {"Content-Type": "application/json"}
 DEFAULT_DEBOUNCE_SECONDS = 25
 DEFAULT_TIMEOUT = 12
+DOC_ID_CACHE_SIZE = 1024
 
 LOG = logging.getLogger("koreader_sync")
 if not LOG.handlers:
@@ -46,8 +56,23 @@ LOG.setLevel(logging.INFO)
 # ------------- Utility & Core Algorithms ------------- #
 
 
+def json_bytes(obj: Any) -> bytes:
+    """Compact UTF-8 JSON body; orjson when installed, stdlib json otherwise."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def json_loads(data: bytes) -> Any:
+    """Parse a raw (UTF-8) JSON response body; orjson when installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 def md5_hex(data: bytes) -> str:
-    return hashlib.md5(data).hexdigest()
+    # Identifiers, not security: also keeps MD5 usable on FIPS-mode OpenSSL.
+    return hashlib.md5(data, usedforsecurity=False).hexdigest()
 
 
 def password_md5(password: str) -> str:
@@ -58,45 +83,52 @@ def doc_id_from_filename(path: str | pathlib.Path) -> str:
     return md5_hex(pathlib.Path(path).name.encode("utf-8"))
 
 
+PARTIAL_MD5_SAMPLE = 1024
+# LuaJIT's bit.lshift masks the shift count, so KOReader's i = -1 sample lands on offset 0.
+PARTIAL_MD5_OFFSETS = tuple(
+    (PARTIAL_MD5_SAMPLE << (2 * i)) if i >= 0 else 0 for i in range(-1, 11)
+)
+
+
 def doc_id_partial_md5(path: str | pathlib.Path) -> str:
     """
     Replicates KOReader 'partial MD5' sampling:
     Offsets: 1024 << (2*i) for i in [-1..10]; read 1024 bytes each; break if EOF reached.
+    All samples are read into one buffer and hashed with a single md5 call.
     """
-    p = pathlib.Path(path)
-    step = size = 1024
-    m = hashlib.md5()
-    with p.open("rb") as f:
-        for i in range(-1, 11):
-            offset = step << (2 * i)
-            try:
+    size = PARTIAL_MD5_SAMPLE
+    buf = bytearray(size * len(PARTIAL_MD5_OFFSETS))
+    view = memoryview(buf)
+    n = 0
+    with pathlib.Path(path).open("rb", buffering=0) as f:
+        fd = f.fileno()
+        for offset in PARTIAL_MD5_OFFSETS:
+            if hasattr(os, "pread"):
+                chunk = os.pread(fd, size, offset)
+                got = len(chunk)
+                view[n:n + got] = chunk
+            else:
                 f.seek(offset)
-            except OSError:
-                break
-            chunk = f.read(size)
-            if not chunk:
+                got = f.readinto(view[n:n + size]) or 0
+            n += got
+            if got < size:  # EOF: every later offset is past the end too
                 break
-            m.update(chunk)
-    return m.hexdigest()
+    return md5_hex(view[:n])
 
 
 def clamp_percentage(p: float) -> float:
-    if p < 0.0:
-        return 0.0
-    if p > 1.0:
-        return 1.0
-    return p
+    return min(1.0, max(0.0, p))
 
 
 def compute_percentage(current_page: int, total_pages: int) -> float:
     if total_pages <= 0:
         return 0.0
-    return clamp_percentage(current_page / float(total_pages))
+    return min(1.0, max(0.0, current_page / total_pages))
 
 
 # ---------------- Data Classes ---------------- #
 
-@dataclass
+@dataclass(slots=True)
 class ProgressRecord:
     document: str
     progress: str      # raw field sent to server
@@ -109,6 +141,19 @@ class ProgressRecord:
     total_pages: Optional[int] = None
     last_push_ts: Optional[float] = None
 
+    @classmethod
+    def from_api(cls, data: Dict[str, Any]) -> ProgressRecord:
+        """Build from a GET /syncs/progress response body."""
+        get = data.get
+        return cls(
+            data["document"],
+            data["progress"],
+            float(data["percentage"]),
+            data["device_id"],
+            get("device", ""),
+            int(get("timestamp") or 0),
+        )
+
     def to_payload(self) -> Dict[str, Any]:
         return {
             "progress": self.progress,
@@ -118,44 +163,90 @@ class ProgressRecord:
             "device": self.device,
         }
 
+    def to_payload_bytes(self) -> bytes:
+        """PUT request body (compact UTF-8 JSON of to_payload())."""
+        return json_bytes(self.to_payload())
+
 
 # ---------------- Persistence Skeleton ---------------- #
 
 class ProgressStore:
     """
-    Extremely simple JSON-lines store.
-    For production: replace with SQLite or app DB.
+    SQLite store (WAL journal): one row per document, each upsert is a single
+    INSERT OR REPLACE, and reads query by primary key instead of loading everything.
+    For production: swap in the app's own DB if it has one.
     """
+    _COLUMNS = (
+        "doc_id, progress, percentage, device_id, device, timestamp,"
+        " local_page, total_pages, last_push_ts"
+    )
+
     def __init__(self, root: str | pathlib.Path):
         self.root = pathlib.Path(root)
         self.root.mkdir(parents=True, exist_ok=True)
-        self.file = self.root / "progress.json"
-        self._cache: Dict[str, ProgressRecord] = {}
-        self._load()
+        self.file = self.root / "progress.db"
+        # One connection shared across threads (flush_retries workers upsert
+        # concurrently); the lock serializes access to it.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.file, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS progress("
+            "doc_id TEXT PRIMARY KEY, progress TEXT, percentage REAL, device_id TEXT,"
+            " device TEXT, timestamp INTEGER, local_page INTEGER, total_pages INTEGER,"
+            " last_push_ts REAL)"
+        )
 
-    def _load(self):
-        if not self.file.exists():
-            return
-        try:
-            raw = json.loads(self.file.read_text("utf-8"))
-            for doc_id, j in raw.items():
-                self._cache[doc_id] = ProgressRecord(**j)
-        except Exception as e:
-            LOG.warning("Failed to load progress store: %s", e)
+    def close(self):
+        with self._lock:
+            self._db.close()
 
-    def _flush(self):
+    def get(self, doc_id: str) -> Optional[ProgressRecord]:
         try:
-            serial = {k: asdict(v) for k, v in self._cache.items()}
-            self.file.write_text(json.dumps(serial, indent=2), encoding="utf-8")
-        except Exception as e:
-            LOG.error("Failed to persist progress store: %s", e)
+            with self._lock:
+                row = self._db.execute(
+                    f"SELECT {self._COLUMNS} FROM progress WHERE doc_id = ?", (doc_id,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            LOG.warning("Failed to read progress store: %s", e)
+            return None
+        return None if row is None else ProgressRecord(*row)
 
-    def get(self, doc_id: str) -> Optional[ProgressRecord]:
-        return self._cache.get(doc_id)
+    def stale(self, max_age: float, now: Optional[float] = None) -> List[str]:
+        """Doc IDs whose last successful push is older than max_age seconds (or never)."""
+        cutoff = (time.time() if now is None else now) - max_age
+        try:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT doc_id FROM progress WHERE last_push_ts IS NULL OR last_push_ts < ?",
+                    (cutoff,),
+                ).fetchall()
+        except sqlite3.Error as e:
+            LOG.warning("Failed to read progress store: %s", e)
+            return []
+        return [r[0] for r in rows]
 
     def upsert(self, record: ProgressRecord):
-        self._cache[record.document] = record
-        self._flush()
+        try:
+            with self._lock:
+                self._db.execute(
+                    f"INSERT OR REPLACE INTO progress({self._COLUMNS})"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        record.document,
+                        record.progress,
+                        record.percentage,
+                        record.device_id,
+                        record.device,
+                        record.timestamp,
+                        record.local_page,
+                        record.total_pages,
+                        record.last_push_ts,
+                    ),
+                )
+        except sqlite3.Error as e:
+            LOG.error("Failed to persist progress store: %s", e)
 
 
 # ---------------- KOReader Sync Client ---------------- #
@@ -169,7 +260,7 @@ class KOSyncClient:
         id_mode: str = "filename",
         work_dir: str | pathlib.Path = "~/.koreader_sync",
         debounce_seconds: int = DEFAULT_DEBOUNCE_SECONDS,
-        session_factory: Callable[[], requests.Session] = requests.Session,
+        session_factory: Optional[Callable[[], requests.Session]] = None,
     ):
         self.username = username
         self.auth_key = password_md5(password_plain)
@@ -184,59 +275,99 @@ class KOSyncClient:
         self.device_id = self._load_or_create_device_id()
 
         self.store = ProgressStore(self.work_dir)
-        self.session = session_factory()
-        self.session.headers.update({"Accept": ACCEPT_HEADER})
+
+        import requests  # deferred so hashing/percentage helpers import without it
+        self._rq = requests
+        self.session = (session_factory or requests.Session)()
+        # Credentials are fixed for the client's lifetime: set once, sent on every request.
+        self.session.headers.update({
+            "Accept": ACCEPT_HEADER,
+            "X-Auth-User": self.username,
+            "X-Auth-Key": self.auth_key,
+        })
+        # Endpoint URLs, resolved once
+        self._auth_url = f"{BASE_URL}/users/auth"
+        self._put_url = f"{BASE_URL}/syncs/progress"
+        self._get_prefix = f"{BASE_URL}/syncs/progress/"
+
         self.lock = threading.Lock()
+        self._last_push_by_path: Dict[str, float] = {}  # abspath -> last push; debounce fast path
+
+        # Partial MD5 memo keyed by (abspath, st_mtime_ns, st_size); LRU-bounded.
+        self._docid_cache: OrderedDict[tuple, str] = OrderedDict()
+        self._docid_lock = threading.Lock()
 
         # Simple retry queue skeleton
         self.retry_queue: List[ProgressRecord] = []
         self.max_retries = 3
 
+    def close(self):
+        """Close the progress store's DB connection and the HTTP session."""
+        self.store.close()
+        self.session.close()
+
     # ---------- Device ID ---------- #
 
     def _load_or_create_device_id(self) -> str:
-        if self._device_id_file.exists():
+        try:
             return self._device_id_file.read_text().strip()
-        did = uuid.uuid4().hex.upper()
+        except FileNotFoundError:
+            pass
+        did = os.urandom(16).hex().upper()  # same shape as uuid4().hex, without importing uuid
         self._device_id_file.write_text(did)
         return did
 
-    # ---------- Headers ---------- #
-
-    def _auth_headers(self, content_type: bool = False) -> Dict[str, str]:
-        h = {
-            "X-Auth-User": self.username,
-            "X-Auth-Key": self.auth_key,
-        }
-        if content_type:
-            h["Content-Type"] = "application/json"
-        return h
-
     # ---------- Document ID ---------- #
 
     def document_id(self, path: str | pathlib.Path) -> str:
         if self.id_mode == "partial":
-            return doc_id_partial_md5(path)
+            st = os.stat(path)
+            key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+            with self._docid_lock:
+                doc_id = self._docid_cache.get(key)
+                if doc_id is not None:
+                    self._docid_cache.move_to_end(key)
+                    return doc_id
+            doc_id = doc_id_partial_md5(path)
+            with self._docid_lock:
+                self._docid_cache[key] = doc_id
+                if len(self._docid_cache) > DOC_ID_CACHE_SIZE:
+                    self._docid_cache.popitem(last=False)
+            return doc_id
         return doc_id_from_filename(path)
 
+    def document_ids(
+        self,
+        paths: Iterable[str | pathlib.Path],
+        max_workers: Optional[int] = None,
+    ) -> List[str]:
+        """
+        Bulk variant of document_id (e.g. library scans); results keep input order.
+        Partial MD5 samples are read and hashed on a thread pool: pread and md5 over
+        the 12 KiB sample both release the GIL, so files are processed in parallel.
+        """
+        paths = list(paths)
+        if self.id_mode != "partial" or len(paths) < 2:
+            return [self.document_id(p) for p in paths]
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            return list(ex.map(self.document_id, paths))
+
     # ---------- Public API ---------- #
 
     def test_auth(self) -> bool:
-        url = f"{BASE_URL}/users/auth"
         try:
-            r = self.session.get(url, headers=self._auth_headers(), timeout=DEFAULT_TIMEOUT)
+            r = self.session.get(self._auth_url, timeout=DEFAULT_TIMEOUT)
             LOG.debug("Auth response %s %s", r.status_code, r.text)
             return r.status_code == 200
-        except requests.RequestException as e:
+        except self._rq.RequestException as e:
             LOG.error("Auth request error: %s", e)
             return False
 
     def get_progress(self, path: str | pathlib.Path) -> Optional[ProgressRecord]:
         doc_id = self.document_id(path)
-        url = f"{BASE_URL}/syncs/progress/{doc_id}"
         try:
-            r = self.session.get(url, headers=self._auth_headers(), timeout=DEFAULT_TIMEOUT)
-        except requests.RequestException as e:
+            r = self.session.get(self._get_prefix + doc_id, timeout=DEFAULT_TIMEOUT)
+        except self._rq.RequestException as e:
             LOG.error("GET progress network error: %s", e)
             return None
 
@@ -249,19 +380,12 @@ class KOSyncClient:
             return None
 
         try:
-            data = r.json()
+            data = json_loads(r.content)
         except Exception:
             LOG.error("Failed to parse JSON: %s", r.text)
             return None
 
-        record = ProgressRecord(
-            document=data["document"],
-            progress=data["progress"],
-            percentage=float(data["percentage"]),
-            device_id=data["device_id"],
-            device=data.get("device", ""),
-            timestamp=int(data.get("timestamp", 0)),
-        )
+        record = ProgressRecord.from_api(data)
         # merge with local store if exists
         local = self.store.get(doc_id)
         if local:
@@ -271,18 +395,22 @@ class KOSyncClient:
         return record
 
     def put_progress(self, record: ProgressRecord) -> bool:
-        url = f"{BASE_URL}/syncs/progress"
-        payload = record.to_payload()
+        if self._do_put(record):
+            return True
+        self._enqueue_retry(record)
+        return False
+
+    def _do_put(self, record: ProgressRecord) -> bool:
+        """Single PUT attempt without the retry-queue side effect."""
         try:
             r = self.session.put(
-                url,
-                headers=self._auth_headers(content_type=True),
-                json=payload,
+                self._put_url,
+                headers=JSON_HEADERS,
+                data=record.to_payload_bytes(),
                 timeout=DEFAULT_TIMEOUT,
             )
-        except requests.RequestException as e:
+        except self._rq.RequestException as e:
             LOG.warning("PUT progress network error: %s", e)
-            self._enqueue_retry(record)
             return False
 
         if r.status_code == 200:
@@ -293,7 +421,6 @@ class KOSyncClient:
         if r.status_code == 401:
             raise PermissionError("Authentication failed (401).")
         LOG.warning("PUT status=%s body=%s", r.status_code, r.text)
-        self._enqueue_retry(record)
         return False
 
     def sync_with_conflict(
@@ -362,11 +489,17 @@ class KOSyncClient:
         """
         Attempt to push progress if debounce interval and page delta conditions met.
         """
-        doc_id = self.document_id(path)
         now = time.time()
+        path_key = os.path.abspath(path)  # same normalization as the document_id memo
         with self.lock:
+            # Cheap in-memory check first: skip the document ID (file I/O + MD5
+            # in partial mode) for calls that are debounced anyway.
+            if not force and (now - self._last_push_by_path.get(path_key, 0)) < self.debounce_seconds:
+                return False
+
+            doc_id = self.document_id(path)
             local = self.store.get(doc_id)
-            last_push = local.last_push_ts if local else 0
+            last_push = (local.last_push_ts if local else None) or 0
             last_page = local.local_page if local and local.local_page is not None else 0
 
             if not force:
@@ -385,7 +518,10 @@ class KOSyncClient:
                 local_page=current_page,
                 total_pages=total_pages,
             )
-            return self.put_progress(record)
+            if not self.put_progress(record):
+                return False
+            self._last_push_by_path[path_key] = record.last_push_ts
+            return True
 
     # ---------- Retry Queue Skeleton ---------- #
 
@@ -393,14 +529,46 @@ class KOSyncClient:
         LOG.debug("Enqueued for retry: %s", record.document)
         self.retry_queue.append(record)
 
-    def flush_retries(self):
-        ok_queue: List[ProgressRecord] = []
-        # naive implementation: attempt once
-        for rec in list(self.retry_queue):
-            if self.put_progress(rec):
-                ok_queue.append(rec)
-        # remove successes
-        self.retry_queue = [r for r in self.retry_queue if r not in ok_queue]
+    def _pool_size(self) -> int:
+        """Keep-alive connections the session's adapter holds for the sync host."""
+        adapter = getattr(self.session, "get_adapter", None)
+        size = getattr(adapter(self._put_url), "_pool_maxsize", None) if adapter else None
+        return size or self._rq.adapters.DEFAULT_POOLSIZE
+
+    def flush_retries(self, max_workers: Optional[int] = None):
+        """
+        Attempt every queued record once, concurrently over the pooled session.
+        max_workers defaults to the session's connection pool size, so every
+        worker gets a kept-alive connection.
+        Older records for a document superseded by a newer queued one are dropped.
+        Records that did not succeed (including 401s) stay queued in their original
+        order; the first PermissionError is re-raised after re-queueing.
+        """
+        pending, self.retry_queue = self.retry_queue, []
+        if not pending:
+            return
+        # Only the newest queued record per document is pushed: the pushes run
+        # concurrently, so sending older snapshots too could let a stale page land last.
+        latest: Dict[str, ProgressRecord] = {}
+        for rec in pending:
+            latest.pop(rec.document, None)
+            latest[rec.document] = rec
+        pending = list(latest.values())
+        with ThreadPoolExecutor(max_workers=max_workers or self._pool_size()) as ex:
+            futures = [ex.submit(self._do_put, rec) for rec in pending]
+        failed: List[ProgressRecord] = []
+        auth_error: Optional[PermissionError] = None
+        for rec, fut in zip(pending, futures):
+            try:
+                if fut.result():
+                    continue
+            except PermissionError as e:
+                auth_error = auth_error or e
+            failed.append(rec)
+        # Keep queue order: older failures ahead of anything enqueued meanwhile.
+        self.retry_queue[:0] = failed
+        if auth_error is not None:
+            raise auth_error
 
     # ---------- CLI Convenience ---------- #
 
@@ -3,8 +3,15 @@
 test_sync.py
 Lightweight test harness for the reference KOReader sync client.
 
-These tests are integration-style: they will talk to the real server if credentials are provided
-via environment variables:
+Offline tests (no network, no credentials; temp work dirs and a stub HTTP session):
+    test_partial_md5_sampling, test_compute_percentage_clamping,
+    test_document_id_memo_invalidation_and_lru, test_progress_store_roundtrip_and_stale,
+    test_flush_retries_*, test_debounced_put_fast_path_offline,
+    test_document_ids_partial_matches_serial
+
+The remaining tests (test_auth, test_put_and_get_*, test_debounce_logic) are
+integration-style: they talk to the real server and need credentials via
+environment variables:
 
     export KOREADER_SYNC_USER="username"
     export KOREADER_SYNC_PASS="plaintext_password"
@@ -24,11 +31,15 @@ from __future__ import annotations
 
 import os
 import time
+import hashlib
 import random
 import string
+import json
+import tempfile
 from pathlib import Path
 
-from koreader_sync import KOSyncClient, compute_percentage
+import koreader_sync
+from koreader_sync import KOSyncClient, ProgressRecord, ProgressStore, clamp_percentage, compute_percentage, doc_id_partial_md5
 
 
 TEST_FILE = Path(__file__).parent / "dummy_book.epub"
@@ -47,6 +58,234 @@ def require_env():
     return user, pwd
 
 
+class StubResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ""
+
+
+class StubSession:
+    """Offline session: PUT status chosen per document via `statuses` (default 200)."""
+
+    def __init__(self, statuses=None):
+        self.headers = {}
+        self.statuses = statuses or {}
+        self.puts = []
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        body = json.loads(data)
+        self.puts.append(body)
+        return StubResponse(self.statuses.get(body["document"], 200))
+
+    def close(self):
+        pass
+
+
+def make_record(doc, progress="1"):
+    return ProgressRecord(document=doc, progress=progress, percentage=0.1, device_id="TEST", device="Stub")
+
+
+def test_partial_md5_sampling():
+    # Offline: compare against a straightforward seek/read/update implementation.
+    m = hashlib.md5()
+    with TEST_FILE.open("rb") as f:
+        for offset in (0, 1024, 4096, 16384):
+            f.seek(offset)
+            chunk = f.read(1024)
+            if not chunk:
+                break
+            m.update(chunk)
+    assert doc_id_partial_md5(TEST_FILE) == m.hexdigest()
+
+
+def test_compute_percentage_clamping():
+    # Offline: ratio clamped to [0, 1]; non-positive totals map to 0.
+    assert compute_percentage(50, 200) == 0.25
+    assert compute_percentage(250, 200) == 1.0
+    assert compute_percentage(-5, 200) == 0.0
+    assert compute_percentage(5, 0) == 0.0
+    assert compute_percentage(5, -10) == 0.0
+    assert clamp_percentage(1.5) == 1.0
+    assert clamp_percentage(-0.5) == 0.0
+    assert clamp_percentage(0.3) == 0.3
+
+
+def test_document_id_memo_invalidation_and_lru():
+    # Offline: the partial-MD5 memo is keyed on (path, mtime, size) and LRU-capped.
+    cap = koreader_sync.DOC_ID_CACHE_SIZE
+    koreader_sync.DOC_ID_CACHE_SIZE = 3
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            client = KOSyncClient("offline", "offline", id_mode="partial", work_dir=tmp)
+            try:
+                book = Path(tmp) / "book.epub"
+                book.write_bytes(b"a" * 5000)
+                first = client.document_id(book)
+                assert client.document_id(book) == first
+
+                # Size change
+                book.write_bytes(b"b" * 6000)
+                second = client.document_id(book)
+                assert second != first and second == doc_id_partial_md5(book)
+
+                # Same size, new content and mtime
+                st = book.stat()
+                book.write_bytes(b"c" * 6000)
+                os.utime(book, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+                third = client.document_id(book)
+                assert third != second and third == doc_id_partial_md5(book)
+
+                for i in range(6):
+                    p = Path(tmp) / f"other{i}.epub"
+                    p.write_bytes(os.urandom(2000))
+                    assert client.document_id(p) == doc_id_partial_md5(p)
+                    assert len(client._docid_cache) <= koreader_sync.DOC_ID_CACHE_SIZE
+                assert len(client._docid_cache) == koreader_sync.DOC_ID_CACHE_SIZE
+            finally:
+                client.close()
+    finally:
+        koreader_sync.DOC_ID_CACHE_SIZE = cap
+
+
+def test_progress_store_roundtrip_and_stale():
+    # Offline: rows survive reopening with every field (incl. None columns) intact.
+    full = ProgressRecord(
+        document="full",
+        progress="/body/DocFragment[3]/body/p[2]",
+        percentage=0.42,
+        device_id="DEV",
+        device="Reader",
+        timestamp=1700000000,
+        local_page=42,
+        total_pages=100,
+        last_push_ts=1000.5,
+    )
+    sparse = make_record("sparse")
+    old = make_record("old")
+    old.last_push_ts = 10.0
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ProgressStore(tmp)
+        try:
+            for rec in (full, sparse, old):
+                store.upsert(rec)
+        finally:
+            store.close()
+
+        store = ProgressStore(tmp)
+        try:
+            assert store.get("full") == full
+            assert store.get("sparse") == sparse
+            assert store.get("missing") is None
+            # never pushed ("sparse") and older than the cutoff ("old"); "full" is fresh
+            assert sorted(store.stale(100, now=1050.0)) == ["old", "sparse"]
+        finally:
+            store.close()
+
+
+def test_flush_retries_keeps_failures_in_order():
+    # Offline: successes leave the queue, failures stay in original order.
+    statuses = {"d1": 500, "d4": 503, "d7": 500}
+    with tempfile.TemporaryDirectory() as tmp:
+        client = KOSyncClient(
+            "offline", "offline", work_dir=tmp, session_factory=lambda: StubSession(statuses)
+        )
+        try:
+            client.retry_queue = [make_record(f"d{i}") for i in range(10)]
+            client.flush_retries()
+            assert [r.document for r in client.retry_queue] == ["d1", "d4", "d7"]
+            assert client.store.get("d0").last_push_ts is not None
+            assert client.store.get("d1") is None
+        finally:
+            client.close()
+
+
+def test_flush_retries_401_requeues_only_unsent():
+    # Offline: a 401 must not put already-pushed records back on the queue.
+    statuses = {"d3": 401, "d6": 500}
+    with tempfile.TemporaryDirectory() as tmp:
+        client = KOSyncClient(
+            "offline", "offline", work_dir=tmp, session_factory=lambda: StubSession(statuses)
+        )
+        try:
+            client.retry_queue = [make_record(f"d{i}") for i in range(10)]
+            try:
+                client.flush_retries()
+            except PermissionError:
+                pass
+            else:
+                raise AssertionError("expected PermissionError")
+            assert [r.document for r in client.retry_queue] == ["d3", "d6"]
+            assert all(r.last_push_ts is None for r in client.retry_queue)
+        finally:
+            client.close()
+
+
+def test_flush_retries_newest_record_per_document_wins():
+    # Offline: several queued page turns for one book must not race; the last one wins.
+    with tempfile.TemporaryDirectory() as tmp:
+        session = StubSession()
+        client = KOSyncClient("offline", "offline", work_dir=tmp, session_factory=lambda: session)
+        try:
+            client.retry_queue = [make_record("same", str(page)) for page in range(1, 11)]
+            client.retry_queue.insert(3, make_record("other"))
+            client.flush_retries()
+            assert client.retry_queue == []
+            same = [p["progress"] for p in session.puts if p["document"] == "same"]
+            assert same == ["10"]
+            assert client.store.get("same").progress == "10"
+            assert client.store.get("other") is not None
+        finally:
+            client.close()
+
+
+def test_debounced_put_fast_path_offline():
+    # Offline: debounce is checked per path before hashing; None push times don't block.
+    with tempfile.TemporaryDirectory() as tmp:
+        client = KOSyncClient(
+            "offline", "offline", id_mode="partial", work_dir=tmp,
+            session_factory=StubSession, debounce_seconds=60,
+        )
+        try:
+            book = Path(tmp) / "book.epub"
+            book.write_bytes(b"a" * 5000)
+            assert client.debounced_put(book, 3, 40, force=True)
+            assert client._last_push_by_path[os.path.abspath(book)] is not None
+
+            def no_hash(path):
+                raise AssertionError("document_id called for a debounced push")
+
+            client.document_id = no_hash
+            # Relative spelling of the same file hits the same fast-path entry.
+            assert not client.debounced_put(os.path.relpath(book), 4, 40)
+            del client.document_id
+
+            other = Path(tmp) / "other.epub"
+            other.write_bytes(b"b" * 5000)
+            client.store.upsert(ProgressRecord(
+                document=client.document_id(other), progress="1", percentage=0.1,
+                device_id="TEST", device="Stub", local_page=1, last_push_ts=None,
+            ))
+            assert client.debounced_put(other, 5, 40)
+        finally:
+            client.close()
+
+
+def test_document_ids_partial_matches_serial():
+    # Offline: the threaded bulk path must match document_id per file, in input order.
+    with tempfile.TemporaryDirectory() as tmp:
+        client = KOSyncClient("offline", "offline", id_mode="partial", work_dir=tmp)
+        try:
+            paths = []
+            for i in range(12):
+                p = Path(tmp) / f"book{i}.epub"
+                p.write_bytes(os.urandom(3000 * i + 1))
+                paths.append(p)
+            paths.reverse()
+            assert client.document_ids(paths) == [doc_id_partial_md5(p) for p in paths]
+        finally:
+            client.close()
+
+
 def test_auth():
     user, pwd = require_env()
     client = KOSyncClient(user, pwd, device_name="PyTestDevice-" + rand_device_suffix())
@@ -100,6 +339,15 @@ def test_debounce_logic():
 if __name__ == "__main__":
     # Run tests manually if not using pytest
     for fn in [
+        test_partial_md5_sampling,
+        test_compute_percentage_clamping,
+        test_document_id_memo_invalidation_and_lru,
+        test_progress_store_roundtrip_and_stale,
+        test_flush_retries_keeps_failures_in_order,
+        test_flush_retries_401_requeues_only_unsent,
+        test_flush_retries_newest_record_per_document_wins,
+        test_debounced_put_fast_path_offline,
+        test_document_ids_partial_matches_serial,
         test_auth,
         test_put_and_get_filename_mode,
         test_put_and_get_partial_md5_mode,